@@ -47,10 +47,6 @@ def main():
         R_ids, AS_ids, U_ids = select_subset_ids(
             text_only_pred, vision_only_pred, gth_label
         )
-
-        import pdb
-
-        pdb.set_trace()
         train_dataset = read_json_file(
             f"../mustard_data/data_raw/mustard_dataset_{split}.json"
         )
@@ -28,9 +28,6 @@ def select_subset_ids(text_label_dict, vision_label_dict, gth_label_dict):
         text_label = text_label_dict.get(id, {}).get("pred")
         vision_label = vision_label_dict.get(id, {}).get("pred")
         if text_label is None or vision_label is None:
-            import pdb
-
-            pdb.set_trace()
             continue
         if text_label == vision_label:
             (R_ids if text_label == gth_label else AS_ids).append(id)
@@ -67,25 +67,13 @@ class MustardDataset(Dataset):
             full_prompt, truncation=True, max_length=max_length, return_tensors="pt"
         )
         seq_len = text_encoding["input_ids"].size(1)
-        padding_length = max_length - seq_len
-
-        if padding_length > 0:
-            pad_ids = torch.full(
-                (1, padding_length), self.tokenizer.pad_token_id, dtype=torch.long
-            )
-            pad_mask = torch.zeros((1, padding_length), dtype=torch.long)
-            text_encoding["input_ids"] = torch.cat(
-                [pad_ids, text_encoding["input_ids"]], dim=1
-            )
-            text_encoding["attention_mask"] = torch.cat(
-                [pad_mask, text_encoding["attention_mask"]], dim=1
-            )
-        else:
-            text_encoding["input_ids"] = text_encoding["input_ids"][:, :max_length]
-            text_encoding["attention_mask"] = text_encoding["attention_mask"][
-                :, :max_length
-            ]
-        return text_encoding
+        input_ids = torch.full(
+            (1, max_length), self.tokenizer.pad_token_id, dtype=torch.long
+        )
+        attention_mask = torch.zeros((1, max_length), dtype=torch.long)
+        input_ids[:, max_length - seq_len :] = text_encoding["input_ids"]
+        attention_mask[:, max_length - seq_len :] = text_encoding["attention_mask"]
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
 
 
 def mustard_collate(batch):
@@ -118,6 +106,10 @@ def get_mustard_dataloader(args, tokenizer, image_processor, split):
             batch_size=args.batch_size,
             shuffle=True,
             collate_fn=mustard_collate,
+            num_workers=args.num_workers,
+            pin_memory=torch.cuda.is_available(),
+            persistent_workers=args.num_workers > 0,
+            prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
         )
     elif split == "val":
         dataset = MustardDataset(
@@ -132,6 +124,10 @@ def get_mustard_dataloader(args, tokenizer, image_processor, split):
             batch_size=args.val_batch_size,
             shuffle=False,
             collate_fn=mustard_collate,
+            num_workers=args.num_workers,
+            pin_memory=torch.cuda.is_available(),
+            persistent_workers=args.num_workers > 0,
+            prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
         )
     elif split == "test":
         dataset = MustardDataset(
@@ -146,4 +142,8 @@ def get_mustard_dataloader(args, tokenizer, image_processor, split):
             batch_size=args.val_batch_size,
             shuffle=False,
             collate_fn=mustard_collate,
+            num_workers=args.num_workers,
+            pin_memory=torch.cuda.is_available(),
+            persistent_workers=args.num_workers > 0,
+            prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
         )
@@ -1,4 +1,5 @@
 import argparse
+import functools
 import json
 import random
 
@@ -14,25 +15,16 @@ from transformers import (AutoProcessor, AutoTokenizer,
                           Blip2ForConditionalGeneration)
 from urfunny import get_urfunny_dataloader
 
+BLIP2_MODEL_NAME = "Salesforce/blip2-opt-2.7b"
+AMP_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
 
-class FocalLoss(nn.Module):
-    def __init__(self, alpha=1, gamma=2, reduction="mean"):
-        super(FocalLoss, self).__init__()
-        self.alpha = alpha
-        self.gamma = gamma
-        self.reduction = reduction
 
-    def forward(self, inputs, targets):
-        BCE_loss = nn.functional.cross_entropy(inputs, targets, reduction="none")
-        pt = torch.exp(-BCE_loss)
-        F_loss = self.alpha * (1 - pt) ** self.gamma * BCE_loss
-
-        if self.reduction == "mean":
-            return torch.mean(F_loss)
-        elif self.reduction == "sum":
-            return torch.sum(F_loss)
-        else:
-            return F_loss
+@torch.jit.script
+def focal_loss(inputs: torch.Tensor, targets: torch.Tensor, alpha: float, gamma: float):
+    # Upcast: scripted code does not follow autocast rules.
+    BCE_loss = nn.functional.cross_entropy(inputs.float(), targets, reduction="none")
+    pt = torch.exp(-BCE_loss)
+    return (alpha * (1 - pt) ** gamma * BCE_loss).mean()
 
 
 def set_seed(seed):
@@ -47,49 +39,73 @@ def set_seed(seed):
     torch.backends.cudnn.benchmark = False
 
 
-def evaluate(tokenizer, model, dataloader, device, args):
+@functools.lru_cache(maxsize=1)
+def load_blip2_processors(local_files_only=False):
+    # Cached so repeated runs in one process (e.g. sweeps) parse the configs once.
+    tokenizer = AutoTokenizer.from_pretrained(
+        BLIP2_MODEL_NAME, local_files_only=local_files_only
+    )
+    processor = AutoProcessor.from_pretrained(
+        BLIP2_MODEL_NAME, local_files_only=local_files_only
+    )
+    return tokenizer, processor
+
+
+def autocast(device, args):
+    return torch.autocast(
+        device_type=device.type,
+        dtype=AMP_DTYPES.get(args.amp_dtype),
+        enabled=device.type == "cuda" and args.amp_dtype in AMP_DTYPES,
+    )
+
+
+def disable_kv_cache(model):
+    # The decoder is built from a copy of text_config, hence the inner config.
+    model.language_model.config.use_cache = False
+
+
+def get_label_token_ids(tokenizer, device):
+    # Order matches the label ids: 0 = no, 1 = yes, 2 = other.
+    return torch.tensor(
+        [
+            tokenizer.convert_tokens_to_ids(tokenizer.tokenize(token))[0]
+            for token in ["no", "yes", "other"]
+        ],
+        device=device,
+    )
+
+
+def evaluate(label_token_ids, model, dataloader, device, args):
     model.eval()
-    total_correct = 0
-    total = 0
-    total_yesno_logits = {}
+    all_ids = []
     all_labels = []
     all_predictions = []
-    yes_token_id = tokenizer.convert_tokens_to_ids(tokenizer.tokenize("yes"))[0]
-    no_token_id = tokenizer.convert_tokens_to_ids(tokenizer.tokenize("no"))[0]
-    other_token_id = tokenizer.convert_tokens_to_ids(tokenizer.tokenize("other"))[0]
+    all_yesno_logits = []
 
     for batch in tqdm(dataloader, desc="Evaluating", leave=False):
-        input_ids = batch["input_ids"].to(device)
-        attention_mask = batch["attention_mask"].to(device)
-        images = batch["image"].to(device)
-        labels = batch["label"].to(device)
-        ids = batch["id"]
+        input_ids = batch["input_ids"].to(device, non_blocking=True)
+        attention_mask = batch["attention_mask"].to(device, non_blocking=True)
+        images = batch["image"].to(device, non_blocking=True)
+        labels = batch["label"].to(device, non_blocking=True)
 
-        with torch.no_grad():
+        with torch.inference_mode(), autocast(device, args):
             outputs = model(
                 input_ids=input_ids, attention_mask=attention_mask, pixel_values=images
             )
-            logits = outputs.logits
-            logits = logits[:, -1, :]
-
-            yesno_logits = torch.stack(
-                [
-                    logits[:, no_token_id],
-                    logits[:, yes_token_id],
-                    logits[:, other_token_id],
-                ],
-                dim=-1,
-            )
+            yesno_logits = outputs.logits[:, -1, :].index_select(1, label_token_ids)
             predictions = torch.argmax(yesno_logits[:, :2], dim=-1)
-            total_correct += (predictions == labels).sum().item()
-            total += labels.size(0)
-            yesno_logits = yesno_logits.tolist()
-            for i, id in enumerate(ids):
-                total_yesno_logits[id] = yesno_logits[i]
-            all_labels.extend(labels.cpu().tolist())
-            all_predictions.extend(predictions.cpu().tolist())
-
-    accuracy = total_correct / total
+
+        # Keep results on the device; they are copied back once after the loop.
+        all_ids.extend(batch["id"])
+        all_labels.append(labels)
+        all_predictions.append(predictions)
+        all_yesno_logits.append(yesno_logits)
+
+    all_labels = torch.cat(all_labels).cpu().numpy()
+    all_predictions = torch.cat(all_predictions).cpu().numpy()
+    total_yesno_logits = dict(zip(all_ids, torch.cat(all_yesno_logits).tolist()))
+
+    accuracy = (all_predictions == all_labels).mean().item()
     f1 = f1_score(all_labels, all_predictions)
     precision = precision_score(all_labels, all_predictions)
     recall = recall_score(all_labels, all_predictions)
@@ -97,29 +113,32 @@ def evaluate(tokenizer, model, dataloader, device, args):
     return accuracy, f1, precision, recall, total_yesno_logits
 
 
-def train(model, train_dataloader, val_dataloader, tokenizer, device, args):
-    optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr)
-    criterion = FocalLoss(alpha=0.25, gamma=2)
-
-    yes_token_id = tokenizer.convert_tokens_to_ids(tokenizer.tokenize("yes"))[0]
-    no_token_id = tokenizer.convert_tokens_to_ids(tokenizer.tokenize("no"))[0]
-    other_token_id = tokenizer.convert_tokens_to_ids(tokenizer.tokenize("other"))[0]
+def train(model, train_dataloader, val_dataloader, label_token_ids, device, args):
+    # Keep the frozen backbone out of the optimizer.
+    trainable_params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = torch.optim.AdamW(
+        trainable_params, lr=args.lr, fused=device.type == "cuda"
+    )
+    # Loss scaling is only needed for fp16; bf16 has the fp32 exponent range.
+    scaler = torch.amp.GradScaler(
+        device.type, enabled=device.type == "cuda" and args.amp_dtype == "fp16"
+    )
 
     best_f1 = -1
-    model.train()
+    best_step = None
 
-    acc, f1, precision, recall, yesno_logits = evaluate(
-        tokenizer, model, val_dataloader, device, args
-    )
-    # model.save_pretrained(args.save_path)
-    # with open(f"{args.save_path}/val_best_f1_yesno_logits.json", "w") as f:
-    #    json.dump(yesno_logits, f)
-    print("Starting point")
-    print(f"Validation Accuracy: {acc:.4f}")
-    print(f"Validation F1 Score: {f1:.4f}")
-    print(f"Validation Precision: {precision:.4f}")
-    print(f"Validation Recall: {recall:.4f}")
+    # Only a reference point for the logs; it plays no part in model selection.
+    if args.eval_before_train:
+        acc, f1, precision, recall, yesno_logits = evaluate(
+            label_token_ids, model, val_dataloader, device, args
+        )
+        print("Starting point")
+        print(f"Validation Accuracy: {acc:.4f}")
+        print(f"Validation F1 Score: {f1:.4f}")
+        print(f"Validation Precision: {precision:.4f}")
+        print(f"Validation Recall: {recall:.4f}")
 
+    model.train()
     total_step = 0
     for epoch in range(args.epochs):
         total_loss = 0
@@ -128,34 +147,32 @@ def train(model, train_dataloader, val_dataloader, tokenizer, device, args):
             tqdm(train_dataloader, desc=f"Epoch {epoch + 1}", leave=False)
         ):
             total_step += 1
-            input_ids = batch["input_ids"].to(device)
-            attention_mask = batch["attention_mask"].to(device)
-            images = batch["image"].to(device)
-            labels = batch["label"].to(device)
+            input_ids = batch["input_ids"].to(device, non_blocking=True)
+            attention_mask = batch["attention_mask"].to(device, non_blocking=True)
+            images = batch["image"].to(device, non_blocking=True)
+            labels = batch["label"].to(device, non_blocking=True)
 
             optimizer.zero_grad()
-            outputs = model(
-                input_ids=input_ids, attention_mask=attention_mask, pixel_values=images
-            )
-            logits = outputs.logits[:, -1, :]
-            yesno_logits = torch.stack(
-                [
-                    logits[:, no_token_id],
-                    logits[:, yes_token_id],
-                    logits[:, other_token_id],
-                ],
-                dim=-1,
-            )
-            loss = criterion(yesno_logits, labels)
-            loss.backward()
-            optimizer.step()
+            with autocast(device, args):
+                outputs = model(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    pixel_values=images,
+                )
+                yesno_logits = outputs.logits[:, -1, :].index_select(1, label_token_ids)
+                loss = focal_loss(yesno_logits, labels, 0.25, 2.0)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
             total_loss += loss.item()
 
             if (total_step + 1) % args.eval_steps == 0:
                 acc, f1, precision, recall, yesno_logits = evaluate(
-                    tokenizer, model, val_dataloader, device, args
+                    label_token_ids, model, val_dataloader, device, args
                 )
+                # evaluate() leaves the model in eval mode.
+                model.train()
                 print(f"Epoch {epoch + 1} Step {step + 1}")
                 print(f"Validation Accuracy: {acc:.4f}")
                 print(f"Validation F1 Score: {f1:.4f}")
@@ -164,6 +181,7 @@ def train(model, train_dataloader, val_dataloader, tokenizer, device, args):
 
                 if f1 >= best_f1:
                     best_f1 = f1
+                    best_step = total_step
                     model.save_pretrained(args.save_path)
                     print("Model saved")
                     with open(
@@ -171,6 +189,8 @@ def train(model, train_dataloader, val_dataloader, tokenizer, device, args):
                     ) as f:
                         json.dump(yesno_logits, f)
 
+    return best_step, total_step
+
 
 def create_dataset_configs(dataset_names, dataset_paths, image_data_paths, max_lengths):
     configs = []
@@ -218,7 +238,7 @@ if __name__ == "__main__":
         help="Path to the image data",
     )
     parser.add_argument(
-        "--batch_size", type=int, default=2, help="Batch size for training"
+        "--batch_size", type=int, default=8, help="Batch size for training"
     )
     parser.add_argument(
         "--val_batch_size", type=int, default=32, help="Batch size for validation"
@@ -226,6 +246,15 @@ if __name__ == "__main__":
     parser.add_argument(
         "--test_batch_size", type=int, default=32, help="Batch size for testing"
     )
+    parser.add_argument(
+        "--num_workers", type=int, default=4, help="Number of dataloader workers"
+    )
+    parser.add_argument(
+        "--prefetch_factor",
+        type=int,
+        default=2,
+        help="Batches prefetched per dataloader worker",
+    )
     parser.add_argument(
         "--max_length",
         type=int,
@@ -236,9 +265,26 @@ if __name__ == "__main__":
         "--epochs", type=int, default=50, help="Number of training epochs"
     )
     parser.add_argument("--lr", type=float, default=5e-5, help="Learning rate")
+    parser.add_argument(
+        "--amp_dtype",
+        type=str,
+        default="bf16",
+        choices=["bf16", "fp16", "fp32"],
+        help="Autocast dtype for forward passes on CUDA (fp32 disables autocast)",
+    )
+    parser.add_argument(
+        "--torch_compile",
+        action="store_true",
+        help="Compile the model forward with torch.compile before training/testing",
+    )
     parser.add_argument(
         "--eval_steps", type=int, default=10, help="Number of steps between evaluations"
     )
+    parser.add_argument(
+        "--eval_before_train",
+        action="store_true",
+        help="Evaluate on the validation set once before the first training step",
+    )
     parser.add_argument("--lora_r", type=int, default=16, help="LoRA r parameter")
     parser.add_argument(
         "--lora_alpha", type=int, default=32, help="LoRA alpha parameter"
@@ -309,19 +355,24 @@ if __name__ == "__main__":
     parser.add_argument(
         "--seed", type=int, default=1234, help="Random seed for initialization"
     )  # Add seed argument
+    parser.add_argument(
+        "--local_files_only",
+        action="store_true",
+        help="Load BLIP2 from the local Hugging Face cache without network calls",
+    )
 
     args = parser.parse_args()
 
     set_seed(args.seed)
 
     # BLIP2 Properties
-    tokenizer = AutoTokenizer.from_pretrained("Salesforce/blip2-opt-2.7b")
-    processor = AutoProcessor.from_pretrained("Salesforce/blip2-opt-2.7b")
+    tokenizer, processor = load_blip2_processors(args.local_files_only)
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    label_token_ids = get_label_token_ids(tokenizer, device)
 
     if args.mode == "train":
         model = Blip2ForConditionalGeneration.from_pretrained(
-            "Salesforce/blip2-opt-2.7b"
+            BLIP2_MODEL_NAME, local_files_only=args.local_files_only
         )
 
         if args.load_from_ckpt:
@@ -338,8 +389,18 @@ if __name__ == "__main__":
             )
             model = get_peft_model(model, config)
 
+        # Recompute activations in backward so larger batches fit in memory.
+        model.gradient_checkpointing_enable(
+            gradient_checkpointing_kwargs={"use_reentrant": False}
+        )
+        model.enable_input_require_grads()
+        disable_kv_cache(model)
+
         model.print_trainable_parameters()
         model.to(device)
+        if args.torch_compile:
+            # Compile in place so save_pretrained still sees the PEFT wrapper.
+            model.compile(dynamic=False)
 
         if args.dataset == "mustard":
             train_dataloader = get_mustard_dataloader(
@@ -372,13 +433,14 @@ if __name__ == "__main__":
                 args, tokenizer, processor, split="test"
             )
 
-        train(model, train_dataloader, val_dataloader, tokenizer, device, args)
-
-        model = PeftModel.from_pretrained(model, args.save_path, is_trainable=True).to(
-            device
+        best_step, last_step = train(
+            model, train_dataloader, val_dataloader, label_token_ids, device, args
         )
+        # The in-memory adapter already is the best one if it was saved last.
+        if best_step is not None and best_step != last_step:
+            model.load_adapter(args.save_path, adapter_name="default")
         acc, f1, precision, recall, yesno_logits = evaluate(
-            tokenizer, model, test_dataloader, device, args
+            label_token_ids, model, test_dataloader, device, args
         )
         print("Test Results:")
         print(f"Test Accuracy: {acc:.4f}")
@@ -388,18 +450,24 @@ if __name__ == "__main__":
 
     elif args.mode == "test":
         model = Blip2ForConditionalGeneration.from_pretrained(
-            "Salesforce/blip2-opt-2.7b"
+            BLIP2_MODEL_NAME, local_files_only=args.local_files_only
+        )
+        # Fold the LoRA deltas into the base weights; inference needs no adapters.
+        model = (
+            PeftModel.from_pretrained(model, args.load_model_name)
+            .merge_and_unload()
+            .to(device)
         )
-        model = PeftModel.from_pretrained(
-            model, args.load_model_name, is_trainable=True
-        ).to(device)
+        disable_kv_cache(model)
+        if args.torch_compile:
+            model.compile(mode="reduce-overhead", dynamic=False)
 
         if args.test_dataset == "mustard":
             test_dataloader = get_mustard_dataloader(
                 args, tokenizer, processor, split="test"
             )
             acc, f1, precision, recall, yesno_logits = evaluate(
-                tokenizer, model, test_dataloader, device, args
+                label_token_ids, model, test_dataloader, device, args
             )
             with open(f"./{args.load_model_name}/test_yesno_logits.json", "w") as f:
                 json.dump(yesno_logits, f)
@@ -410,7 +478,7 @@ if __name__ == "__main__":
                 args, tokenizer, processor, split="test"
             )
             acc, f1, precision, recall, yesno_logits = evaluate(
-                tokenizer, model, test_dataloader, device, args
+                label_token_ids, model, test_dataloader, device, args
             )
 
         elif args.test_dataset == "mmsd":
@@ -418,7 +486,7 @@ if __name__ == "__main__":
                 args, tokenizer, processor, split="test"
             )
             acc, f1, precision, recall, yesno_logits = evaluate(
-                tokenizer, model, test_dataloader, device, args
+                label_token_ids, model, test_dataloader, device, args
             )
             with open(f"./{args.load_model_name}/test_yesno_logits.json", "w") as f:
                 json.dump(yesno_logits, f)
@@ -429,7 +497,7 @@ if __name__ == "__main__":
                 args, tokenizer, processor, split="test"
             )
             acc, f1, precision, recall, yesno_logits = evaluate(
-                tokenizer, model, test_dataloader, device, args
+                label_token_ids, model, test_dataloader, device, args
             )
             with open(f"./{args.load_model_name}/test_yesno_logits.json", "w") as f:
                 json.dump(yesno_logits, f)
@@ -97,25 +97,13 @@ class URFUNNYDataset(Dataset):
             full_prompt, truncation=True, max_length=max_length, return_tensors="pt"
         )
         seq_len = text_encoding["input_ids"].size(1)
-        padding_length = max_length - seq_len
-
-        if padding_length > 0:
-            pad_ids = torch.full(
-                (1, padding_length), self.tokenizer.pad_token_id, dtype=torch.long
-            )
-            pad_mask = torch.zeros((1, padding_length), dtype=torch.long)
-            text_encoding["input_ids"] = torch.cat(
-                [pad_ids, text_encoding["input_ids"]], dim=1
-            )
-            text_encoding["attention_mask"] = torch.cat(
-                [pad_mask, text_encoding["attention_mask"]], dim=1
-            )
-        else:
-            text_encoding["input_ids"] = text_encoding["input_ids"][:, :max_length]
-            text_encoding["attention_mask"] = text_encoding["attention_mask"][
-                :, :max_length
-            ]
-        return text_encoding
+        input_ids = torch.full(
+            (1, max_length), self.tokenizer.pad_token_id, dtype=torch.long
+        )
+        attention_mask = torch.zeros((1, max_length), dtype=torch.long)
+        input_ids[:, max_length - seq_len :] = text_encoding["input_ids"]
+        attention_mask[:, max_length - seq_len :] = text_encoding["attention_mask"]
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
 
 
 def urfunny_collate(batch):
@@ -150,6 +138,10 @@ def get_urfunny_dataloader(args, tokenizer, image_processor, split):
             batch_size=args.batch_size,
             shuffle=True,
             collate_fn=urfunny_collate,
+            num_workers=args.num_workers,
+            pin_memory=torch.cuda.is_available(),
+            persistent_workers=args.num_workers > 0,
+            prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
         )
     elif split == "val":
         dataset = URFUNNYDataset(
@@ -164,6 +156,10 @@ def get_urfunny_dataloader(args, tokenizer, image_processor, split):
             batch_size=args.val_batch_size,
             shuffle=False,
             collate_fn=urfunny_collate,
+            num_workers=args.num_workers,
+            pin_memory=torch.cuda.is_available(),
+            persistent_workers=args.num_workers > 0,
+            prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
         )
     elif split == "test":
         dataset = URFUNNYDataset(
@@ -178,4 +174,8 @@ def get_urfunny_dataloader(args, tokenizer, image_processor, split):
             batch_size=args.test_batch_size,
             shuffle=False,
             collate_fn=urfunny_collate,
+            num_workers=args.num_workers,
+            pin_memory=torch.cuda.is_available(),
+            persistent_workers=args.num_workers > 0,
+            prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
         )
@@ -1,5 +1,5 @@
-import json
-
+import numpy as np
+import orjson
 import torch
 from torch.utils.data import DataLoader, Dataset
 
@@ -10,14 +10,24 @@ class MustardDataset(Dataset):
     """
 
     def __init__(self, dataset_path, tokenizer, max_length=512):
-        self.dataset = self.load_dataset(dataset_path)
+        dataset = self.load_dataset(dataset_path)
         self.tokenizer = tokenizer
         self.tokenizer.pad_token = self.tokenizer.eos_token
         self.max_length = max_length
+        assert self.tokenizer.is_fast, "expected a fast (Rust) tokenizer"
+        self.input_ids, self.attention_mask = self.tokenize_and_left_pad(
+            [self.build_prompt(item) for item in dataset], self.max_length
+        )
+        self.labels = torch.as_tensor(
+            [item["label"] for item in dataset], dtype=torch.long
+        )
+        self.ids = np.array([item["id"] for item in dataset])
+        for tensor in (self.input_ids, self.attention_mask, self.labels):
+            tensor.share_memory_()
 
     def load_dataset(self, dataset_path):
-        with open(dataset_path) as f:
-            raw_dataset = json.load(f)
+        with open(dataset_path, "rb") as f:
+            raw_dataset = orjson.loads(f.read())
         return [
             {
                 "id": id,
@@ -33,55 +43,54 @@ class MustardDataset(Dataset):
         ]
 
     def __len__(self):
-        return len(self.dataset)
+        return len(self.labels)
 
-    def __getitem__(self, idx):
-        item = self.dataset[idx]
+    def build_prompt(self, item):
         text = item["utterance"]
         speaker = item["speaker"]
         show = item["show"]
-        id = item["id"]
         context = item["context"]
         speakers = item["context_speakers"]
         fullContext = ""
         for i in range(len(speakers)):
             currentUtterance = f"{speakers[i]}:f{context[i]}"
             fullContext += currentUtterance
-        label = torch.tensor(item["label"], dtype=torch.long)
-        full_prompt = f"Question: You are watching an episode of {show}. Following up to this image input, the dialogue has been {fullContext}. Given the current speaker is {speaker} who says {text} - are they being sarcastic? Answer:"
+        return f"Question: You are watching an episode of {show}. Following up to this image input, the dialogue has been {fullContext}. Given the current speaker is {speaker} who says {text} - are they being sarcastic? Answer:"
 
-        text_encoding = self.tokenize_and_left_pad(full_prompt, self.max_length)
+    def __getitem__(self, idx):
         return {
-            "input_ids": text_encoding["input_ids"].squeeze(),
-            "attention_mask": text_encoding["attention_mask"].squeeze(),
-            "label": label,
-            "id": id,
+            "input_ids": self.input_ids[idx],
+            "attention_mask": self.attention_mask[idx],
+            "label": self.labels[idx],
+            "id": str(self.ids[idx]),
         }
 
-    def tokenize_and_left_pad(self, full_prompt, max_length):
-        text_encoding = self.tokenizer(
-            full_prompt, truncation=True, max_length=max_length, return_tensors="pt"
+    def tokenize_and_left_pad(self, prompts, max_length):
+        # Right-align each sequence in a buffer pre-filled with padding.
+        encodings = self.tokenizer(prompts, truncation=True, max_length=max_length)
+        input_ids = torch.full(
+            (len(prompts), max_length), self.tokenizer.pad_token_id, dtype=torch.int32
         )
-        seq_len = text_encoding["input_ids"].size(1)
-        padding_length = max_length - seq_len
-
-        if padding_length > 0:
-            pad_ids = torch.full(
-                (1, padding_length), self.tokenizer.pad_token_id, dtype=torch.long
-            )
-            pad_mask = torch.zeros((1, padding_length), dtype=torch.long)
-            text_encoding["input_ids"] = torch.cat(
-                [pad_ids, text_encoding["input_ids"]], dim=1
-            )
-            text_encoding["attention_mask"] = torch.cat(
-                [pad_mask, text_encoding["attention_mask"]], dim=1
-            )
-        else:
-            text_encoding["input_ids"] = text_encoding["input_ids"][:, :max_length]
-            text_encoding["attention_mask"] = text_encoding["attention_mask"][
-                :, :max_length
-            ]
-        return text_encoding
+        attention_mask = torch.zeros((len(prompts), max_length), dtype=torch.int8)
+        for i, ids in enumerate(encodings["input_ids"]):
+            input_ids[i, max_length - len(ids) :] = torch.tensor(ids)
+            attention_mask[i, max_length - len(ids) :] = 1
+        return input_ids, attention_mask
+
+
+class MustardBatch:
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __getitem__(self, key):
+        return self.fields[key]
+
+    def pin_memory(self):
+        self.fields = {
+            key: value.pin_memory() if torch.is_tensor(value) else value
+            for key, value in self.fields.items()
+        }
+        return self
 
 
 def mustard_collate(batch):
@@ -90,12 +99,14 @@ def mustard_collate(batch):
     labels = torch.stack([item["label"] for item in batch])
     ids = [item["id"] for item in batch]
 
-    return {
-        "input_ids": input_ids,
-        "attention_mask": attention_masks,
-        "label": labels,
-        "id": ids,
-    }
+    return MustardBatch(
+        {
+            "input_ids": input_ids,
+            "attention_mask": attention_masks,
+            "label": labels,
+            "id": ids,
+        }
+    )
 
 
 def get_mustard_dataloader(args, tokenizer, split):
@@ -106,6 +117,7 @@ def get_mustard_dataloader(args, tokenizer, split):
             batch_size=args.batch_size,
             shuffle=True,
             collate_fn=mustard_collate,
+            pin_memory=torch.cuda.is_available(),
         )
     elif split == "val":
         dataset = MustardDataset(args.val_path, tokenizer, args.max_length)
@@ -114,6 +126,7 @@ def get_mustard_dataloader(args, tokenizer, split):
             batch_size=args.batch_size,
             shuffle=False,
             collate_fn=mustard_collate,
+            pin_memory=torch.cuda.is_available(),
         )
     elif split == "test":
         dataset = MustardDataset(args.test_path, tokenizer, args.max_length)
@@ -122,4 +135,5 @@ def get_mustard_dataloader(args, tokenizer, split):
             batch_size=args.batch_size,
             shuffle=False,
             collate_fn=mustard_collate,
+            pin_memory=torch.cuda.is_available(),
         )
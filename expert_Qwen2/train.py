@@ -30,9 +30,10 @@ def evaluate(tokenizer, model, dataloader, device, args):
     e_token_id = tokenizer.convert_tokens_to_ids(tokenizer.tokenize("5"))[0]
 
     for batch in tqdm(dataloader, desc="Evaluating", leave=False):
-        input_ids = batch["input_ids"].to(device)
-        attention_mask = batch["attention_mask"].to(device)
-        labels = batch["label"].to(device)
+        # MUSTARD text is stored compactly (int32 ids, int8 mask); widen on device.
+        input_ids = batch["input_ids"].to(device, non_blocking=True).long()
+        attention_mask = batch["attention_mask"].to(device, non_blocking=True).long()
+        labels = batch["label"].to(device, non_blocking=True)
         ids = batch["id"]
 
         with torch.no_grad():
@@ -95,9 +96,11 @@ def train(model, train_dataloader, val_dataloader, tokenizer, device, args):
         for step, batch in enumerate(
             tqdm(train_dataloader, desc=f"Epoch {epoch + 1}", leave=False)
         ):
-            input_ids = batch["input_ids"].to(device)
-            attention_mask = batch["attention_mask"].to(device)
-            labels = batch["label"].to(device)
+            input_ids = batch["input_ids"].to(device, non_blocking=True).long()
+            attention_mask = (
+                batch["attention_mask"].to(device, non_blocking=True).long()
+            )
+            labels = batch["label"].to(device, non_blocking=True)
 
             optimizer.zero_grad()
             outputs = model(input_ids=input_ids, attention_mask=attention_mask)
@@ -36,7 +36,69 @@ class FocalLoss(nn.Module):
             return F_loss
 
 
-def evaluate(tokenizer, model, dataloader, device):
+def get_image_stats(processor, device):
+    image_processor = processor.image_processor
+    mean = torch.tensor(image_processor.image_mean, device=device).view(1, -1, 1, 1)
+    std = torch.tensor(image_processor.image_std, device=device).view(1, -1, 1, 1)
+    return mean, std
+
+
+def normalize_images(images, image_stats):
+    # URFUNNY sends resized uint8 NHWC; permuting gives channels_last NCHW.
+    if images.dtype != torch.uint8:
+        return images
+    mean, std = image_stats
+    return images.permute(0, 3, 1, 2).float().div_(255).sub_(mean).div_(std)
+
+
+class CUDAPrefetcher:
+    """Iterates a DataLoader one batch ahead, copying the next batch to the
+    device on a side stream while the model works on the current one."""
+
+    def __init__(self, dataloader, device, image_stats):
+        self.dataloader = dataloader
+        self.device = device
+        self.image_stats = image_stats
+        # torch.cuda.stream(None) is a no-op, so CPU runs share the same path.
+        self.stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        batches = iter(self.dataloader)
+        next_batch = self.preload(batches)
+        while next_batch is not None:
+            batch = next_batch
+            if self.stream is not None:
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_stream(self.stream)
+                # Keep side-stream allocations alive for the compute stream.
+                for value in batch.values():
+                    if torch.is_tensor(value):
+                        value.record_stream(current_stream)
+            next_batch = self.preload(batches)
+            yield batch
+
+    def preload(self, batches):
+        batch = next(batches, None)
+        if batch is None:
+            return None
+        with torch.cuda.stream(self.stream):
+            input_ids, attention_mask, images, labels = (
+                batch[key].to(self.device, non_blocking=True)
+                for key in ["input_ids", "attention_mask", "image", "label"]
+            )
+            return {
+                "input_ids": input_ids.long(),
+                "attention_mask": attention_mask.long(),
+                "image": normalize_images(images, self.image_stats),
+                "label": labels,
+                "id": batch["id"],
+            }
+
+
+def evaluate(tokenizer, model, dataloader, device, image_stats):
     model.eval()
     total_correct, total = 0, 0
     all_labels, all_predictions = [], []
@@ -46,10 +108,13 @@ def evaluate(tokenizer, model, dataloader, device):
         for token in ["R", "U", "S"]
     }
 
-    for batch in tqdm(dataloader, desc="Evaluating", leave=False):
+    for batch in tqdm(
+        CUDAPrefetcher(dataloader, device, image_stats),
+        desc="Evaluating",
+        leave=False,
+    ):
         input_ids, attention_mask, images, labels = (
-            batch[key].to(device)
-            for key in ["input_ids", "attention_mask", "image", "label"]
+            batch[key] for key in ["input_ids", "attention_mask", "image", "label"]
         )
         ids = batch["id"]
 
@@ -79,7 +144,9 @@ def evaluate(tokenizer, model, dataloader, device):
     }
 
 
-def train(model, train_dataloader, val_dataloader, tokenizer, device, args):
+def train(
+    model, train_dataloader, val_dataloader, tokenizer, device, image_stats, args
+):
     optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr)
     criterion = FocalLoss(alpha=1, gamma=2)
     token_ids = {
@@ -93,11 +160,14 @@ def train(model, train_dataloader, val_dataloader, tokenizer, device, args):
         model.train()
 
         for step, batch in enumerate(
-            tqdm(train_dataloader, desc=f"Epoch {epoch + 1}", leave=False)
+            tqdm(
+                CUDAPrefetcher(train_dataloader, device, image_stats),
+                desc=f"Epoch {epoch + 1}",
+                leave=False,
+            )
         ):
             input_ids, attention_mask, images, labels = (
-                batch[key].to(device)
-                for key in ["input_ids", "attention_mask", "image", "label"]
+                batch[key] for key in ["input_ids", "attention_mask", "image", "label"]
             )
 
             optimizer.zero_grad()
@@ -114,7 +184,9 @@ def train(model, train_dataloader, val_dataloader, tokenizer, device, args):
             total_loss += loss.item()
 
             if (step + 1) % args.eval_steps == 0:
-                metrics = evaluate(tokenizer, model, val_dataloader, device)
+                metrics = evaluate(
+                    tokenizer, model, val_dataloader, device, image_stats
+                )
                 print(
                     f"Epoch {epoch + 1} Step {step + 1} - Val Accuracy: {metrics['accuracy']:.4f}, F1: {metrics['f1']:.4f}, Precision: {metrics['precision']:.4f}, Recall: {metrics['recall']:.4f}"
                 )
@@ -141,6 +213,21 @@ if __name__ == "__main__":
     parser.add_argument(
         "--val_batch_size", type=int, default=32, help="Batch size for validation"
     )
+    parser.add_argument(
+        "--num_workers", type=int, default=8, help="Number of dataloader workers"
+    )
+    parser.add_argument(
+        "--prefetch_factor",
+        type=int,
+        default=4,
+        help="Batches prefetched per dataloader worker",
+    )
+    parser.add_argument(
+        "--image_cache_dir",
+        type=str,
+        default=None,
+        help="Directory for preprocessed uint8 image caches (URFUNNY)",
+    )
     parser.add_argument(
         "--max_length",
         type=int,
@@ -179,6 +266,7 @@ if __name__ == "__main__":
     tokenizer = AutoTokenizer.from_pretrained("Salesforce/blip2-opt-2.7b")
     processor = AutoProcessor.from_pretrained("Salesforce/blip2-opt-2.7b")
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    image_stats = get_image_stats(processor, device)
 
     if args.mode == "train":
         model = Blip2ForConditionalGeneration.from_pretrained(
@@ -214,12 +302,20 @@ if __name__ == "__main__":
             args, tokenizer, processor, split="val"
         )
 
-        train(model, train_dataloader, val_dataloader, tokenizer, device, args)
+        train(
+            model,
+            train_dataloader,
+            val_dataloader,
+            tokenizer,
+            device,
+            image_stats,
+            args,
+        )
 
         test_dataloader = dataloaders[args.dataset](
             args, tokenizer, processor, split="test"
         )
-        metrics = evaluate(tokenizer, model, test_dataloader, device)
+        metrics = evaluate(tokenizer, model, test_dataloader, device, image_stats)
         print(
             f"Test Results - Accuracy: {metrics['accuracy']:.4f}, F1: {metrics['f1']:.4f}, Precision: {metrics['precision']:.4f}, Recall: {metrics['recall']:.4f}"
         )
@@ -241,7 +337,7 @@ if __name__ == "__main__":
         test_dataloader = dataloaders[args.dataset](
             args, tokenizer, processor, split="test"
         )
-        metrics = evaluate(tokenizer, model, test_dataloader, device)
+        metrics = evaluate(tokenizer, model, test_dataloader, device, image_stats)
 
         with open(f"./{args.load_model_name}/test_rus_logits.json", "w") as f:
             json.dump(metrics["rus_logits"], f)
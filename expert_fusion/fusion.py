@@ -2,27 +2,28 @@ import json
 import os
 from collections import defaultdict
 
-import jsonlines
 import numpy as np
-from sklearn.metrics import (accuracy_score, f1_score, precision_score,
-                             recall_score)
+import orjson
+from scipy.special import softmax
+from sklearn.metrics import accuracy_score, precision_recall_fscore_support
 
 
 def load_weights(weights_file):
-    with jsonlines.open(weights_file, "r") as f:
-        return {line["image_id"]: line["logits"] for line in f}
+    with open(weights_file, "rb") as f:
+        return {line["image_id"]: line["logits"] for line in map(orjson.loads, f)}
 
 
 def load_and_transform_data(dataset_name, file_dir, subset_names, weights=None):
-    results = defaultdict(
-        lambda: {"logits": defaultdict(list), "target": None, "weights": {}}
-    )
+    results = defaultdict(lambda: {"logits": {}, "target": None, "weights": {}})
     for name in subset_names:
         file_path = os.path.join(file_dir, f"{dataset_name}_{name}_logits.jsonl")
-        with jsonlines.open(file_path, "r") as f:
-            for line in f:
+        with open(file_path, "rb") as f:
+            for raw_line in f:
+                line = orjson.loads(raw_line)
                 data_id = line["image_id"]
-                results[data_id]["logits"][name] = line["logits"]
+                results[data_id]["logits"][name] = np.asarray(
+                    line["logits"], dtype=np.float32
+                )
                 results[data_id]["target"] = (
                     results[data_id]["target"] or line["target"]
                 )
@@ -35,10 +36,13 @@ def load_and_transform_data(dataset_name, file_dir, subset_names, weights=None):
 
 
 def calculate_metrics(gths, preds):
+    precision, recall, f1, _ = precision_recall_fscore_support(
+        gths, preds, average="binary", zero_division=0
+    )
     return {
-        "f1": f1_score(gths, preds),
-        "precision": precision_score(gths, preds),
-        "recall": recall_score(gths, preds),
+        "f1": f1,
+        "precision": precision,
+        "recall": recall,
         "accuracy": accuracy_score(gths, preds),
     }
 
@@ -53,20 +57,11 @@ def get_predictions(results, fusion_strategy, *args):
 
 
 def weighted_softmax_rus_fusion(logits, weights, *args):
-    softmax_weights = {
-        "R": np.exp(weights["R"])
-        / (np.exp(weights["R"]) + np.exp(weights["U"]) + np.exp(weights["AS"])),
-        "U": np.exp(weights["U"])
-        / (np.exp(weights["R"]) + np.exp(weights["U"]) + np.exp(weights["AS"])),
-        "AS": np.exp(weights["AS"])
-        / (np.exp(weights["R"]) + np.exp(weights["U"]) + np.exp(weights["AS"])),
-    }
-    softmax_logits = {
-        name: np.exp(logit) / np.sum(np.exp(logit)) for name, logit in logits.items()
-    }
+    softmax_weights = dict(
+        zip(["R", "U", "AS"], softmax([weights["R"], weights["U"], weights["AS"]]))
+    )
     weighted_logits = sum(
-        softmax_weights[name] * np.array(logit)
-        for name, logit in softmax_logits.items()
+        softmax_weights[name] * softmax(logit) for name, logit in logits.items()
     )
     return np.argmax(weighted_logits)
 
@@ -77,7 +72,7 @@ def simple_average(logits, *args):
 
 
 def weighted_average(logits, weights, *args):
-    weighted_logits = sum(weights[name] * np.array(logits[name]) for name in logits)
+    weighted_logits = sum(weights[name] * logits[name] for name in logits)
     return np.argmax(weighted_logits)
 
 
@@ -87,23 +82,20 @@ def max_fusion(logits, *args):
 
 
 def softmax_fusion(logits, *args):
-    softmaxed_probs = np.mean(
-        [np.exp(logits[name]) / np.sum(np.exp(logits[name])) for name in logits], axis=0
-    )
+    softmaxed_probs = np.mean([softmax(logits[name]) for name in logits], axis=0)
     return np.argmax(softmaxed_probs)
 
 
 def cascaded_fusion(logits, threshold, *args):
-    softmaxed_probs = {
-        name: np.exp(logit) / np.sum(np.exp(logit)) for name, logit in logits.items()
-    }
-    if max(softmaxed_probs["R"]) > threshold and max(softmaxed_probs["U"]) > threshold:
-        return np.argmax(
-            softmaxed_probs["R"]
-            if max(softmaxed_probs["R"]) > max(softmaxed_probs["U"])
-            else softmaxed_probs["U"]
+    softmaxed_probs = {name: softmax(logit) for name, logit in logits.items()}
+    max_R, max_U = softmaxed_probs["R"].max(), softmaxed_probs["U"].max()
+    if max_R > threshold and max_U > threshold:
+        return (
+            softmaxed_probs["R"].argmax()
+            if max_R > max_U
+            else softmaxed_probs["U"].argmax()
         )
-    return np.argmax(softmaxed_probs["AS"])
+    return softmaxed_probs["AS"].argmax()
 
 
 def get_oracle_prediction(dataset_name, logits):
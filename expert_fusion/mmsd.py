@@ -33,6 +33,10 @@ class MMSDDataset(Dataset):
         self.image_processor = image_processor
         self.image_data_path = image_data_path
         self.max_length = max_length
+        self.prompts = [
+            f"The tweet related to this image is: {item['text']}. What type of multimodal interaction is that?"
+            for item in self.dataset
+        ]
 
     def load_dataset(self, dataset_files):
         overall_dataset = []
@@ -63,7 +67,7 @@ class MMSDDataset(Dataset):
         ).pixel_values.squeeze(0)
         label = torch.tensor(item["label"], dtype=torch.long)
         text_encoding = self.tokenizer(
-            f"The tweet related to this image is: {item['text']}. What type of multimodal interaction is that?",
+            self.prompts[idx],
             truncation=True,
             max_length=self.max_length,
             return_tensors="pt",
@@ -1,184 +1,124 @@
 import os
 from collections import defaultdict
 
-import jsonlines
 import numpy as np
-from sklearn.metrics import (accuracy_score, f1_score, precision_score,
-                             recall_score)
+import orjson
+from scipy.special import softmax
+from sklearn.metrics import accuracy_score, precision_recall_fscore_support
 
 
 def load_and_transform_baseline(file_dir):
     subset_names = ["baseline"]
-    dataset = defaultdict(list)
-    results = defaultdict(lambda: {"logits": defaultdict(list), "target": None})
+    results = defaultdict(lambda: {"logits": {}, "target": None})
 
     # Load data from files
     for name in subset_names:
         file_path = os.path.join(file_dir, f"mmsd_{name}_logits.jsonl")
-        with jsonlines.open(file_path, "r") as f:
-            for line in f:
+        with open(file_path, "rb") as f:
+            for raw_line in f:
+                line = orjson.loads(raw_line)
                 image_id, text = line["image_id"], line["text"]
                 data_id = f"{image_id}_{text}"
-                dataset[name].append(line)
                 results[data_id]["logits"][name] = line["logits"]
                 if results[data_id]["target"] is None:
                     results[data_id]["target"] = line["target"]
                 assert (
                     results[data_id]["target"] == line["target"]
                 ), "Targets do not match across subsets for the same data."
-    return dataset, results
+    return stack_results(results)
 
 
 def load_and_transform_data(file_dir):
     subset_names = ["AS", "R", "U"]
-    dataset = defaultdict(list)
-    results = defaultdict(lambda: {"logits": defaultdict(list), "target": None})
+    results = defaultdict(lambda: {"logits": {}, "target": None})
 
     # Load data from files
     for name in subset_names:
         file_path = os.path.join(file_dir, f"mmsd_{name}_logits.jsonl")
-        with jsonlines.open(file_path, "r") as f:
-            for line in f:
+        with open(file_path, "rb") as f:
+            for raw_line in f:
+                line = orjson.loads(raw_line)
                 image_id = line["image_id"]
                 # text = line['text']
                 data_id = f"{image_id}"
-                dataset[name].append(line)
                 results[data_id]["logits"][name] = line["logits"]
                 if results[data_id]["target"] is None:
                     results[data_id]["target"] = line["target"]
                 assert (
                     results[data_id]["target"] == line["target"]
                 ), "Targets do not match across subsets for the same data."
-    return dataset, results
+    return stack_results(results)
+
+
+def stack_results(results):
+    data_ids = list(results.keys())
+    subset_names = list(results[data_ids[0]]["logits"].keys())
+    logits = {
+        name: np.array([results[data_id]["logits"][name] for data_id in data_ids])
+        for name in subset_names
+    }
+    return {
+        "data_ids": data_ids,
+        "logits": logits,
+        "probs": {name: softmax(arr, axis=-1) for name, arr in logits.items()},
+        "target": np.array([results[data_id]["target"] for data_id in data_ids]),
+    }
+
+
+def calculate_metrics(gths, preds):
+    precision, recall, f1, _ = precision_recall_fscore_support(
+        gths, preds, average="binary", zero_division=0
+    )
+    return f1, precision, recall, accuracy_score(gths, preds)
 
 
 def interaction_type_acc(results, interaction_type="AS"):
-    gths = []
-    preds = []
-    for data_id, data in results.items():
-        total_logits = data["logits"][interaction_type]
-        predicted_label = total_logits.index(max(total_logits))
-        gths.append(data["target"])
-        preds.append(predicted_label)
-    f1, precision, recall, accuracy = (
-        f1_score(gths, preds),
-        precision_score(gths, preds),
-        recall_score(gths, preds),
-        accuracy_score(gths, preds),
-    )
-    return f1, precision, recall, accuracy
+    preds = np.argmax(results["logits"][interaction_type], axis=1)
+    return calculate_metrics(results["target"], preds)
 
 
 def simple_average_fusion(results):
-    gths = []
-    preds = []
-    for data_id, data in results.items():
-        total_logits = [
-            sum(logits) / len(logits) for logits in zip(*data["logits"].values())
-        ]
-        predicted_label = total_logits.index(max(total_logits))
-        gths.append(data["target"])
-        preds.append(predicted_label)
-    f1, precision, recall, accuracy = (
-        f1_score(gths, preds),
-        precision_score(gths, preds),
-        recall_score(gths, preds),
-        accuracy_score(gths, preds),
-    )
-    return f1, precision, recall, accuracy
+    stacked_logits = np.stack(list(results["logits"].values()), axis=0)
+    preds = np.argmax(np.mean(stacked_logits, axis=0), axis=1)
+    return calculate_metrics(results["target"], preds)
 
 
 def weighted_average_fusion(results, weights):
-    gths = []
-    preds = []
-    for data_id, data in results.items():
-        weighted_logits = [
-            sum(w * logits[i] for w, logits in zip(weights, data["logits"].values()))
-            for i in range(len(next(iter(data["logits"].values()))))
-        ]
-        predicted_label = weighted_logits.index(max(weighted_logits))
-        gths.append(data["target"])
-        preds.append(predicted_label)
-    f1, precision, recall, accuracy = (
-        f1_score(gths, preds),
-        precision_score(gths, preds),
-        recall_score(gths, preds),
-        accuracy_score(gths, preds),
-    )
-    return f1, precision, recall, accuracy
+    stacked_logits = np.stack(list(results["logits"].values())[: len(weights)], axis=0)
+    preds = np.argmax(np.tensordot(weights, stacked_logits, axes=1), axis=1)
+    return calculate_metrics(results["target"], preds)
 
 
 def max_fusion(results):
-    gths = []
-    preds = []
-    for data_id, data in results.items():
-        max_logits = [max(logits) for logits in zip(*data["logits"].values())]
-        predicted_label = max_logits.index(max(max_logits))
-        gths.append(data["target"])
-        preds.append(predicted_label)
-    f1, precision, recall, accuracy = (
-        f1_score(gths, preds),
-        precision_score(gths, preds),
-        recall_score(gths, preds),
-        accuracy_score(gths, preds),
-    )
-    return f1, precision, recall, accuracy
+    stacked_logits = np.stack(list(results["logits"].values()), axis=0)
+    preds = np.argmax(np.max(stacked_logits, axis=0), axis=1)
+    return calculate_metrics(results["target"], preds)
 
 
 def softmax_fusion(results):
-    gths = []
-    preds = []
-    for data_id, data in results.items():
-        softmaxed_probs = [
-            np.exp(logits) / np.sum(np.exp(logits))
-            for logits in data["logits"].values()
-        ]
-        average_probs = np.mean(softmaxed_probs, axis=0)
-        predicted_label = np.argmax(average_probs)
-        gths.append(data["target"])
-        preds.append(predicted_label)
-    f1, precision, recall, accuracy = (
-        f1_score(gths, preds),
-        precision_score(gths, preds),
-        recall_score(gths, preds),
-        accuracy_score(gths, preds),
-    )
-    return f1, precision, recall, accuracy
+    stacked_probs = np.stack(list(results["probs"].values()), axis=0)
+    preds = np.argmax(stacked_probs.mean(axis=0), axis=1)
+    return calculate_metrics(results["target"], preds)
 
 
 def cascaded_fusion(results, threshold):
-    gths = []
-    preds = []
-    softmaxed_probs = {}
-    for data_id, data in results.items():
-        for interaction_type, logits in data["logits"].items():
-            softmaxed_probs[interaction_type] = np.exp(logits) / np.sum(np.exp(logits))
-        if (
-            np.max(softmaxed_probs["R"]) > threshold
-            and np.max(softmaxed_probs["U"]) > threshold
-        ):
-            predicted_label = (
-                np.argmax(softmaxed_probs["R"])
-                if np.max(softmaxed_probs["R"]) > np.max(softmaxed_probs["U"])
-                else np.argmax(softmaxed_probs["U"])
-            )
-        else:
-            predicted_label = np.argmax(softmaxed_probs["AS"])
-        gths.append(data["target"])
-        preds.append(predicted_label)
-    f1, precision, recall, accuracy = (
-        f1_score(gths, preds),
-        precision_score(gths, preds),
-        recall_score(gths, preds),
-        accuracy_score(gths, preds),
+    softmaxed_probs = results["probs"]
+    max_R = softmaxed_probs["R"].max(axis=1)
+    max_U = softmaxed_probs["U"].max(axis=1)
+    mask = (max_R > threshold) & (max_U > threshold)
+    pick = np.where(
+        max_R > max_U,
+        softmaxed_probs["R"].argmax(axis=1),
+        softmaxed_probs["U"].argmax(axis=1),
     )
-    return f1, precision, recall, accuracy
+    preds = np.where(mask, pick, softmaxed_probs["AS"].argmax(axis=1))
+    return calculate_metrics(results["target"], preds)
 
 
 # Example usage within your main workflow
 if __name__ == "__main__":
     file_dir = "../mmsd_data/expert_inference_output/expert_albef"
-    _, transformed_results = load_and_transform_data(file_dir)
+    transformed_results = load_and_transform_data(file_dir)
 
     weights = {"AS": 0.0, "R": 0.2, "U": 0.2}
     weighted_weights = [weights[name] for name in ["AS", "R", "U"]]
@@ -204,7 +144,7 @@ if __name__ == "__main__":
     print(
         "U Interaction Type Accuracy:", interaction_type_acc(transformed_results, "U")
     )
-    baseline_dataset, baseline_results = load_and_transform_baseline(file_dir)
+    baseline_results = load_and_transform_baseline(file_dir)
     print(
         "Baseline Interaction Type Accuracy:",
         interaction_type_acc(baseline_results, "baseline"),
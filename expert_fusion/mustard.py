@@ -21,6 +21,15 @@ class MustardDataset(Dataset):
         self.image_processor = image_processor
         self.image_data_path = image_data_path
         self.max_length = max_length
+        self.prompts = [
+            (
+                f"Question: You are watching an episode of {item['show']}. "
+                f"Following up to this image input, the dialogue has been {item['context']}. "
+                f"Given the current speaker is {item['speaker']} who says {item['utterance']} - "
+                f"are they being sarcastic? Answer:"
+            )
+            for item in self.dataset
+        ]
 
     def load_dataset(self, dataset_dict):
         label_map = {"R": 0, "U": 1, "S": 2}
@@ -54,15 +63,8 @@ class MustardDataset(Dataset):
         ).pixel_values.squeeze(0)
         label = torch.tensor(item["label"], dtype=torch.long)
 
-        full_prompt = (
-            f"Question: You are watching an episode of {item['show']}. "
-            f"Following up to this image input, the dialogue has been {item['context']}. "
-            f"Given the current speaker is {item['speaker']} who says {item['utterance']} - "
-            f"are they being sarcastic? Answer:"
-        )
-
         text_encoding = self.tokenizer(
-            full_prompt,
+            self.prompts[idx],
             truncation=True,
             max_length=self.max_length,
             padding="max_length",
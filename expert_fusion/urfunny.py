@@ -1,45 +1,91 @@
-import json
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+import orjson
 import torch
 from PIL import Image
 from torch.utils.data import DataLoader, Dataset
+from tqdm import tqdm
 
 
 class URFUNNYDataset(Dataset):
     def __init__(
-        self, split, image_data_path, tokenizer, image_processor, max_length=512
+        self,
+        split,
+        image_data_path,
+        tokenizer,
+        image_processor,
+        max_length=512,
+        image_cache_dir=None,
     ):
-        if split == "train":
-            dataset_files = {
-                "R": "../urfunny_data/data_split_output/urfunny_R_dataset_train_cogvlm2_qwen2_for_fuser.json",
-                "U": "../urfunny_data/data_split_output/urfunny_U_dataset_train_cogvlm2_qwen2_for_fuser.json",
-                "S": "../urfunny_data/data_split_output/urfunny_AS_dataset_train_cogvlm2_qwen2_for_fuser.json",
-            }
-        elif split == "val":
-            dataset_files = {
-                "R": "../urfunny_data/data_split_output/urfunny_R_dataset_val_cogvlm2_qwen2_for_fuser.json",
-                "U": "../urfunny_data/data_split_output/urfunny_U_dataset_val_cogvlm2_qwen2_for_fuser.json",
-                "S": "../urfunny_data/data_split_output/urfunny_AS_dataset_val_cogvlm2_qwen2_for_fuser.json",
-            }
-        elif split == "test":
-            dataset_files = {
-                "R": "../urfunny_data/data_split_output/urfunny_R_dataset_test_cogvlm2_qwen2_for_fuser.json",
-                "U": "../urfunny_data/data_split_output/urfunny_U_dataset_test_cogvlm2_qwen2_for_fuser.json",
-                "S": "../urfunny_data/data_split_output/urfunny_AS_dataset_test_cogvlm2_qwen2_for_fuser.json",
-            }
-        self.dataset = self.load_dataset(dataset_files)
+        dataset = self.load_dataset(self.get_dataset_files(split))
         self.tokenizer = tokenizer
         self.image_processor = image_processor
         self.image_data_path = image_data_path
         self.max_length = max_length
+        # Prompts are fixed per sample, so tokenize the whole split once.
+        assert self.tokenizer.is_fast, "expected a fast (Rust) tokenizer"
+        self.input_ids, self.attention_mask = self.tokenize_and_left_pad(
+            [
+                f"The text is: {item['text']}. What type of multimodal interaction is that?"
+                for item in dataset
+            ]
+        )
+        self.labels = torch.as_tensor(
+            [item["label"] for item in dataset], dtype=torch.long
+        )
+        self.paths = self.get_image_paths(dataset, image_data_path)
+        self.image_cache_path = None
+        self.image_cache = None
+        if image_cache_dir is not None:
+            self.image_cache_path = self.get_cache_path(
+                image_cache_dir, split, self.paths
+            )
+            if not os.path.exists(self.image_cache_path):
+                os.makedirs(image_cache_dir, exist_ok=True)
+                self.build_cache(self.image_cache_path, self.paths, image_processor)
+            num_cached = np.load(self.image_cache_path, mmap_mode="r").shape[0]
+            if num_cached != len(self.paths):
+                raise ValueError(
+                    f"{self.image_cache_path} holds {num_cached} images but the "
+                    f"split has {len(self.paths)}; delete it to rebuild"
+                )
+        # Flat columns avoid copy-on-write of per-sample objects in workers.
+        self.ids = np.array([item["id"] for item in dataset])
+        for tensor in (self.input_ids, self.attention_mask, self.labels):
+            tensor.share_memory_()
+
+    @staticmethod
+    def get_dataset_files(split):
+        return {
+            type: f"../urfunny_data/data_split_output/urfunny_{subset}_dataset_{split}_cogvlm2_qwen2_for_fuser.json"
+            for type, subset in [("R", "R"), ("U", "U"), ("S", "AS")]
+        }
+
+    @staticmethod
+    def get_image_paths(dataset, image_data_path):
+        image_data_path = os.fspath(image_data_path)
+        return np.array(
+            [f'{image_data_path}/{item["image_id"]}.png' for item in dataset]
+        )
 
-    def load_dataset(self, dataset_files):
+    @staticmethod
+    def load_json(file_path):
+        with open(file_path, "rb") as f:
+            return orjson.loads(f.read())
+
+    @classmethod
+    def load_dataset(cls, dataset_files):
         overall_dataset = []
         label_map = {"R": 0, "U": 1, "S": 2}
 
-        for type, file_path in dataset_files.items():
-            with open(file_path) as f:
-                data = json.load(f)
+        with ThreadPoolExecutor(max_workers=len(dataset_files)) as executor:
+            subsets = dict(
+                zip(dataset_files, executor.map(cls.load_json, dataset_files.values()))
+            )
+        for type, data in subsets.items():
             for id, content in data.items():
                 overall_dataset.append(
                     {
@@ -51,95 +97,138 @@ class URFUNNYDataset(Dataset):
                 )
         return overall_dataset
 
+    def tokenize_and_left_pad(self, prompts):
+        # Left-pad so the last position is always the final prompt token.
+        encodings = self.tokenizer(prompts, truncation=True, max_length=self.max_length)
+        seq_len = max(len(ids) for ids in encodings["input_ids"])
+        # Compact dtypes; the training loop widens them on the device.
+        input_ids = torch.zeros((len(prompts), seq_len), dtype=torch.int32)
+        attention_mask = torch.zeros((len(prompts), seq_len), dtype=torch.int8)
+        for i, ids in enumerate(encodings["input_ids"]):
+            input_ids[i, seq_len - len(ids) :] = torch.tensor(ids)
+            attention_mask[i, seq_len - len(ids) :] = 1
+        return input_ids, attention_mask
+
+    @staticmethod
+    def load_image(image_path, image_processor):
+        # Resize only; rescaling and normalization happen on the GPU.
+        with Image.open(image_path) as image:
+            pixel_values = image_processor(
+                image,
+                do_rescale=False,
+                do_normalize=False,
+                data_format="channels_last",
+                return_tensors="pt",
+            ).pixel_values
+        return pixel_values.squeeze(0).to(torch.uint8)
+
+    @staticmethod
+    def get_cache_path(image_cache_dir, split, image_paths):
+        # Keyed on the image list so a changed split never reuses stale rows.
+        digest = hashlib.sha1("\n".join(image_paths).encode()).hexdigest()[:16]
+        return f"{image_cache_dir}/urfunny_{split}_{digest}_images.npy"
+
+    @classmethod
+    def build_cache(cls, cache_path, image_paths, image_processor):
+        if len(image_paths) == 0:
+            raise ValueError(f"No images to cache for {cache_path}")
+        # Write then rename so an interrupted build is never picked up.
+        tmp_path = f"{cache_path}.tmp"
+        cache = None
+        for i, image_path in enumerate(tqdm(image_paths, desc=f"Caching {cache_path}")):
+            image = cls.load_image(image_path, image_processor)
+            if cache is None:
+                cache = np.lib.format.open_memmap(
+                    tmp_path,
+                    mode="w+",
+                    dtype=np.uint8,
+                    shape=(len(image_paths), *image.shape),
+                )
+            cache[i] = image.numpy()
+        cache.flush()
+        del cache
+        os.replace(tmp_path, cache_path)
+
     def __len__(self):
-        return len(self.dataset)
+        return len(self.labels)
 
     def __getitem__(self, idx):
-        item = self.dataset[idx]
-        image_path = f'{self.image_data_path}/{item["image_id"]}.png'
-        image = self.image_processor(
-            Image.open(image_path), return_tensors="pt"
-        ).pixel_values.squeeze(0)
-        label = torch.tensor(item["label"], dtype=torch.long)
-        text_encoding = self.tokenizer(
-            f"The text is: {item['text']}. What type of multimodal interaction is that?",
-            truncation=True,
-            max_length=self.max_length,
-            return_tensors="pt",
-            padding="longest",
-        )
+        if self.image_cache_path is not None:
+            # Opened lazily so each worker maps the file itself.
+            if self.image_cache is None:
+                self.image_cache = np.load(self.image_cache_path, mmap_mode="r")
+            image = torch.from_numpy(np.array(self.image_cache[idx]))
+        else:
+            image = self.load_image(self.paths[idx], self.image_processor)
 
         return {
-            "input_ids": text_encoding["input_ids"].squeeze(),
-            "attention_mask": text_encoding["attention_mask"].squeeze(),
+            "input_ids": self.input_ids[idx],
+            "attention_mask": self.attention_mask[idx],
             "image": image,
-            "label": label,
-            "id": item["id"],
+            "label": self.labels[idx],
+            "id": str(self.ids[idx]),
         }
 
 
+class UrfunnyBatch:
+    # Not a Mapping, so the DataLoader calls pin_memory() below.
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __getitem__(self, key):
+        return self.fields[key]
+
+    def pin_memory(self):
+        self.fields = {
+            key: value.pin_memory() if torch.is_tensor(value) else value
+            for key, value in self.fields.items()
+        }
+        return self
+
+
 def urfunny_collate(batch):
-    # pad the input_ids and attention_mask to the same length, adding padding to the left side
-    max_length = max(len(item["input_ids"]) for item in batch)
-
-    for item in batch:
-        padding_length = max_length - len(item["input_ids"])
-        if padding_length > 0:
-            pad_ids = torch.full((padding_length,), 0, dtype=torch.long)
-            pad_mask = torch.zeros((padding_length,), dtype=torch.long)
-            item["input_ids"] = torch.cat([pad_ids, item["input_ids"]], dim=0)
-            item["attention_mask"] = torch.cat(
-                [pad_mask, item["attention_mask"]], dim=0
-            )
+    # Drop the columns that are padding for every sample in the batch.
+    input_ids = torch.stack([item["input_ids"] for item in batch])
+    attention_mask = torch.stack([item["attention_mask"] for item in batch])
+    start = int((~attention_mask.bool().any(0)).sum())
+    input_ids, attention_mask = input_ids[:, start:], attention_mask[:, start:]
 
-    # Ensure image tensors have the same dimensions
     max_image_shape = tuple(
         max(s) for s in zip(*[item["image"].shape for item in batch])
     )
-    for item in batch:
-        pad_image = torch.zeros(max_image_shape, dtype=item["image"].dtype)
-        pad_image[
-            : item["image"].shape[0], : item["image"].shape[1], : item["image"].shape[2]
-        ] = item["image"]
-        item["image"] = pad_image
-
-    return {
-        "input_ids": torch.stack([item["input_ids"] for item in batch]),
-        "attention_mask": torch.stack([item["attention_mask"] for item in batch]),
-        "image": torch.stack([item["image"] for item in batch]),
-        "label": torch.stack([item["label"] for item in batch]),
-        "id": [item["id"] for item in batch],
-    }
+    images = torch.zeros((len(batch), *max_image_shape), dtype=batch[0]["image"].dtype)
+    for i, item in enumerate(batch):
+        height, width, channels = item["image"].shape
+        images[i, :height, :width, :channels] = item["image"]
+
+    return UrfunnyBatch(
+        {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "image": images,
+            "label": torch.stack([item["label"] for item in batch]),
+            "id": [item["id"] for item in batch],
+        }
+    )
 
 
 def get_urfunny_dataloader(args, tokenizer, image_processor, split):
-    if split == "train":
-        dataset = URFUNNYDataset(
-            split, args.image_data_path, tokenizer, image_processor, args.max_length
-        )
-        return DataLoader(
-            dataset,
-            batch_size=args.batch_size,
-            shuffle=True,
-            collate_fn=urfunny_collate,
-        )
-    elif split == "val":
-        dataset = URFUNNYDataset(
-            split, args.image_data_path, tokenizer, image_processor, args.max_length
-        )
-        return DataLoader(
-            dataset,
-            batch_size=args.val_batch_size,
-            shuffle=False,
-            collate_fn=urfunny_collate,
-        )
-    elif split == "test":
-        dataset = URFUNNYDataset(
-            split, args.image_data_path, tokenizer, image_processor, args.max_length
-        )
-        return DataLoader(
-            dataset,
-            batch_size=args.val_batch_size,
-            shuffle=False,
-            collate_fn=urfunny_collate,
-        )
+    dataset = URFUNNYDataset(
+        split,
+        args.image_data_path,
+        tokenizer,
+        image_processor,
+        args.max_length,
+        args.image_cache_dir,
+    )
+    batch_size = args.batch_size if split == "train" else args.val_batch_size
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=(split == "train"),
+        collate_fn=urfunny_collate,
+        num_workers=args.num_workers,
+        pin_memory=torch.cuda.is_available(),
+        persistent_workers=args.num_workers > 0,
+        prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
+    )
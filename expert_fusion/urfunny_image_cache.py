@@ -0,0 +1,30 @@
+import argparse
+import os
+
+from transformers import AutoProcessor
+from urfunny import URFUNNYDataset
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Precompute the resized uint8 URFUNNY image caches for the fuser"
+    )
+    parser.add_argument(
+        "--image_data_path", type=str, required=True, help="Path to the image data"
+    )
+    parser.add_argument(
+        "--image_cache_dir",
+        type=str,
+        required=True,
+        help="Directory to write the per-split image caches to",
+    )
+    args = parser.parse_args()
+
+    processor = AutoProcessor.from_pretrained("Salesforce/blip2-opt-2.7b")
+    os.makedirs(args.image_cache_dir, exist_ok=True)
+
+    for split in ["train", "val", "test"]:
+        dataset = URFUNNYDataset.load_dataset(URFUNNYDataset.get_dataset_files(split))
+        paths = URFUNNYDataset.get_image_paths(dataset, args.image_data_path)
+        cache_path = URFUNNYDataset.get_cache_path(args.image_cache_dir, split, paths)
+        if not os.path.exists(cache_path):
+            URFUNNYDataset.build_cache(cache_path, paths, processor)